@@ -1,47 +1,166 @@
+import contextlib
+import functools
+import io
 import json
+import os
 import tarfile
 from pathlib import Path
 
 import pytest
 
+import datasets.config
 from datasets import Audio, DownloadManager, Features, Image, List, Value, Video
 from datasets.packaged_modules.webdataset.webdataset import WebDataset
 
 from ..utils import (
     require_numpy1_on_windows,
     require_pil,
-    require_torch,
-    require_torchcodec,
 )
 
 
-@pytest.fixture
-def gzipped_text_wds_file(tmp_path, text_gz_path):
-    filename = tmp_path / "file.tar"
-    num_examples = 3
-    with tarfile.open(str(filename), "w") as f:
-        for example_idx in range(num_examples):
-            f.add(text_gz_path, f"{example_idx:05d}.txt.gz")
-    return str(filename)
+if datasets.config.PIL_AVAILABLE:
+    import PIL.Image
+
+
+_JSON_BYTES = {
+    "image": b'{"caption": "this is an image"}',
+    "audio": b'{"transcript": "this is a transcript"}',
+    "video": b'{"caption": "this is a video"}',
+    "tensor": b'{"text": "this is a text"}',
+}
+
+
+_EXPECTED_GZ_TEXT_FEATURES = Features(
+    {
+        "__key__": Value("string"),
+        "__url__": Value("string"),
+        "txt.gz": Value("string"),
+    }
+)
+_EXPECTED_IMAGE_FEATURES = Features(
+    {
+        "__key__": Value("string"),
+        "__url__": Value("string"),
+        "json": {"caption": Value("string")},
+        "jpg": Image(),
+    }
+)
+_EXPECTED_AUDIO_FEATURES = Features(
+    {
+        "__key__": Value("string"),
+        "__url__": Value("string"),
+        "json": {"transcript": Value("string")},
+        "wav": Audio(),
+    }
+)
+_EXPECTED_VIDEO_FEATURES = Features(
+    {
+        "__key__": Value("string"),
+        "__url__": Value("string"),
+        "json": {"caption": Value("string")},
+        "mov": Video(),
+    }
+)
+_EXPECTED_TENSOR_FEATURES = Features(
+    {
+        "__key__": Value("string"),
+        "__url__": Value("string"),
+        "json": {"text": Value("string")},
+        "pth": List(Value("float32")),
+    }
+)
+_USER_IMAGE_FEATURES_MISSING_KEYS = Features(
+    {
+        "__key__": Value("string"),
+        "__url__": Value("string"),
+        "json": {"caption": Value("string")},
+        "jpg": Image(),
+        "jpeg": Image(),  # additional field
+        "txt": Value("string"),  # additional field
+    }
+)
+_USER_IMAGE_FEATURES_EXTRA_FIELD = Features(
+    {
+        "__key__": Value("string"),
+        "__url__": Value("string"),
+        "json": {"caption": Value("string"), "additional_field": Value("int64")},
+        "jpg": Image(),
+    }
+)
+
+
+@contextlib.contextmanager
+def _open_tar(path):
+    # stream mode ("w|") writes sequentially without seeking, and the 1MB buffer batches the 512-byte tar blocks;
+    # copybufsize raises the 16KB chunks tarfile uses to copy each member's payload
+    with (
+        open(path, "wb", buffering=1 << 20) as fileobj,
+        tarfile.open(fileobj=fileobj, mode="w|", copybufsize=1 << 20) as tar,
+    ):
+        yield tar
+
+
+def _add_bytes(tar, arcname, data):
+    # write the member from memory instead of tar.add() to avoid a stat + open of the source per example
+    info = tarfile.TarInfo(arcname)
+    info.size = len(data)
+    info.mtime = 0  # reproducible archives
+    tar.addfile(info, io.BytesIO(data))
 
 
-@pytest.fixture
-def image_wds_file(tmp_path, image_file):
-    json_file = tmp_path / "data.json"
-    filename = tmp_path / "file.tar"
+@functools.lru_cache
+def _example_names(num_examples):
+    # format the zero-padded example names once and share them across fixtures
+    return tuple(f"{example_idx:05d}" for example_idx in range(num_examples))
+
+
+def _build_tar(path, entries):
+    with _open_tar(path) as tar:
+        for arcname, data in entries:
+            _add_bytes(tar, arcname, data)
+    return path
+
+
+@pytest.fixture(scope="module")
+def download_manager():
+    # shared by the tests of this module only: it records the paths it downloads and extracts
+    return DownloadManager()
+
+
+@pytest.fixture(scope="session")
+def caption_json_path(tmp_path_factory):
+    path = tmp_path_factory.mktemp("wds") / "caption.json"
+    path.write_bytes(_JSON_BYTES["image"])
+    return path
+
+
+@pytest.fixture(scope="session")
+def gzipped_text_wds_file(tmp_path_factory, text_gz_path):
+    data_dir = tmp_path_factory.mktemp("wds")
+    filename = os.fspath(data_dir / "file.tar")
     num_examples = 3
-    with json_file.open("w", encoding="utf-8") as f:
-        f.write(json.dumps({"caption": "this is an image"}))
-    with tarfile.open(str(filename), "w") as f:
-        for example_idx in range(num_examples):
-            f.add(json_file, f"{example_idx:05d}.json")
-            f.add(image_file, f"{example_idx:05d}.jpg")
-    return str(filename)
+    data = Path(text_gz_path).read_bytes()
+    entries = [(name + ".txt.gz", data) for name in _example_names(num_examples)]
+    return _build_tar(filename, entries)
 
 
-@pytest.fixture
-def upper_lower_case_file(tmp_path):
-    tar_path = tmp_path / "file.tar"
+@pytest.fixture(scope="session")
+def image_wds_file(tmp_path_factory, image_file):
+    data_dir = tmp_path_factory.mktemp("wds")
+    filename = os.fspath(data_dir / "file.tar")
+    num_examples = 3
+    json_data = _JSON_BYTES["image"]
+    data = Path(image_file).read_bytes()
+    entries = []
+    for name in _example_names(num_examples):
+        entries += [(name + ".json", json_data), (name + ".jpg", data)]
+    return _build_tar(filename, entries)
+
+
+@pytest.fixture(scope="session")
+def upper_lower_case_file(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp("wds")
+    tar_path = os.fspath(data_dir / "file.tar")
     num_examples = 3
     variants = [
         ("INFO1", "json"),
@@ -49,127 +168,170 @@ def upper_lower_case_file(tmp_path):
         ("info3", "JSON"),
         ("info3", "json"),  # should probably remove if testing on a case insensitive filesystem
     ]
-    with tarfile.open(tar_path, "w") as tar:
+    with _open_tar(tar_path) as tar:
         for example_idx in range(num_examples):
             example_name = f"{example_idx:05d}_{'a' if example_idx % 2 else 'A'}"
             for tag, ext in variants:
-                caption_path = tmp_path / f"{example_name}.{tag}.{ext}"
+                caption_path = data_dir / f"{example_name}.{tag}.{ext}"
                 caption_text = {"caption": f"caption for {example_name}.{tag}.{ext}"}
                 caption_path.write_text(json.dumps(caption_text), encoding="utf-8")
                 tar.add(caption_path, arcname=f"{example_name}.{tag}.{ext}")
-    return str(tar_path)
+    return tar_path
 
 
-@pytest.fixture
-def audio_wds_file(tmp_path, audio_file):
-    json_file = tmp_path / "data.json"
-    filename = tmp_path / "file.tar"
+@pytest.fixture(scope="session")
+def audio_wds_file(tmp_path_factory, audio_file):
+    data_dir = tmp_path_factory.mktemp("wds")
+    filename = os.fspath(data_dir / "file.tar")
     num_examples = 3
-    with json_file.open("w", encoding="utf-8") as f:
-        f.write(json.dumps({"transcript": "this is a transcript"}))
-    with tarfile.open(str(filename), "w") as f:
-        for example_idx in range(num_examples):
-            f.add(json_file, f"{example_idx:05d}.json")
-            f.add(audio_file, f"{example_idx:05d}.wav")
-    return str(filename)
-
-
-@pytest.fixture
-def video_wds_file(tmp_path):
-    json_file = tmp_path / "data.json"
-    filename = tmp_path / "file.tar"
+    json_data = _JSON_BYTES["audio"]
+    data = Path(audio_file).read_bytes()
+    entries = []
+    for name in _example_names(num_examples):
+        entries += [(name + ".json", json_data), (name + ".wav", data)]
+    return _build_tar(filename, entries)
+
+
+@pytest.fixture(scope="session")
+def video_wds_file(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp("wds")
+    filename = os.fspath(data_dir / "file.tar")
     video_file = Path(__file__).resolve().parents[1] / "features" / "data" / "test_video_66x50.mov"
     num_examples = 3
-    with json_file.open("w", encoding="utf-8") as f:
-        f.write(json.dumps({"caption": "this is a video"}))
-    with tarfile.open(str(filename), "w") as f:
-        for example_idx in range(num_examples):
-            f.add(json_file, f"{example_idx:05d}.json")
-            f.add(video_file, f"{example_idx:05d}.mov")
-    return str(filename)
-
-
-@pytest.fixture
-def bad_wds_file(tmp_path, image_file, text_file):
-    json_file = tmp_path / "data.json"
-    filename = tmp_path / "bad_file.tar"
-    with json_file.open("w", encoding="utf-8") as f:
-        f.write(json.dumps({"caption": "this is an image"}))
-    with tarfile.open(str(filename), "w") as f:
+    json_data = _JSON_BYTES["video"]
+    data = video_file.read_bytes()
+    entries = []
+    for name in _example_names(num_examples):
+        entries += [(name + ".json", json_data), (name + ".mov", data)]
+    return _build_tar(filename, entries)
+
+
+@pytest.fixture(scope="session")
+def bad_wds_file(tmp_path_factory, image_file, text_file, caption_json_path):
+    data_dir = tmp_path_factory.mktemp("wds")
+    filename = os.fspath(data_dir / "bad_file.tar")
+    with _open_tar(filename) as f:
         f.add(image_file)
-        f.add(json_file)
-    return str(filename)
+        f.add(caption_json_path)
+    return filename
 
 
-@pytest.fixture
-def tensor_wds_file(tmp_path, tensor_file):
-    json_file = tmp_path / "data.json"
-    filename = tmp_path / "file.tar"
+@pytest.fixture(scope="session")
+def tensor_wds_file(tmp_path_factory, tensor_file):
+    data_dir = tmp_path_factory.mktemp("wds")
+    filename = os.fspath(data_dir / "file.tar")
     num_examples = 3
-    with json_file.open("w", encoding="utf-8") as f:
-        f.write(json.dumps({"text": "this is a text"}))
-    with tarfile.open(str(filename), "w") as f:
-        for example_idx in range(num_examples):
-            f.add(json_file, f"{example_idx:05d}.json")
-            f.add(tensor_file, f"{example_idx:05d}.pth")
-    return str(filename)
+    json_data = _JSON_BYTES["tensor"]
+    data = Path(tensor_file).read_bytes()
+    entries = []
+    for name in _example_names(num_examples):
+        entries += [(name + ".json", json_data), (name + ".pth", data)]
+    return _build_tar(filename, entries)
 
 
-@require_pil
-def test_gzipped_text_webdataset(gzipped_text_wds_file, text_path):
-    data_files = {"train": [gzipped_text_wds_file]}
-    webdataset = WebDataset(data_files=data_files)
-    split_generators = webdataset._split_generators(DownloadManager())
-    assert webdataset.info.features == Features(
-        {
-            "__key__": Value("string"),
-            "__url__": Value("string"),
-            "txt.gz": Value("string"),
-        }
-    )
-    assert len(split_generators) == 1
-    split_generator = split_generators[0]
-    assert split_generator.name == "train"
-    generator = webdataset._generate_examples(**split_generator.gen_kwargs)
-    _, examples = zip(*generator)
-    assert len(examples) == 3
-    assert isinstance(examples[0]["txt.gz"], str)
+def _check_gzipped_text_example(example, text_path):
+    assert isinstance(example["txt.gz"], str)
     with open(text_path, "r") as f:
-        assert examples[0]["txt.gz"].replace("\r\n", "\n") == f.read().replace("\r\n", "\n")
+        assert example["txt.gz"].replace("\r\n", "\n") == f.read().replace("\r\n", "\n")
 
 
-@require_pil
-def test_image_webdataset(image_wds_file):
-    import PIL.Image
+def _check_image_example(example, features):
+    assert isinstance(example["json"], dict)
+    assert isinstance(example["json"]["caption"], str)
+    assert isinstance(example["jpg"], dict)  # keep encoded to avoid unecessary copies
+    encoded = features.encode_example(example)
+    decoded = features.decode_example(encoded)
+    assert isinstance(decoded["json"], dict)
+    assert isinstance(decoded["json"]["caption"], str)
+    assert isinstance(decoded["jpg"], PIL.Image.Image)
 
-    data_files = {"train": [image_wds_file]}
+
+def _check_audio_example(example, features):
+    from torchcodec.decoders import AudioDecoder
+
+    assert isinstance(example["json"], dict)
+    assert isinstance(example["json"]["transcript"], str)
+    assert isinstance(example["wav"], dict)
+    assert isinstance(example["wav"]["bytes"], bytes)  # keep encoded to avoid unecessary copies
+    encoded = features.encode_example(example)
+    decoded = features.decode_example(encoded)
+    assert isinstance(decoded["json"], dict)
+    assert isinstance(decoded["json"]["transcript"], str)
+    assert isinstance(decoded["wav"], AudioDecoder)
+
+
+def _check_tensor_example(example, features):
+    import torch
+
+    assert isinstance(example["json"], dict)
+    assert isinstance(example["json"]["text"], str)
+    assert isinstance(example["pth"], torch.Tensor)  # keep encoded to avoid unecessary copies
+    encoded = features.encode_example(example)
+    decoded = features.decode_example(encoded)
+    assert isinstance(decoded["json"], dict)
+    assert isinstance(decoded["json"]["text"], str)
+    assert isinstance(decoded["pth"], list)
+
+
+# case -> (tar fixture, expected inferred features, checks on the first example)
+_WDS_CASES = {
+    "gzipped_text": ("gzipped_text_wds_file", _EXPECTED_GZ_TEXT_FEATURES, _check_gzipped_text_example),
+    "image": ("image_wds_file", _EXPECTED_IMAGE_FEATURES, _check_image_example),
+    "audio": ("audio_wds_file", _EXPECTED_AUDIO_FEATURES, _check_audio_example),
+    "tensor": ("tensor_wds_file", _EXPECTED_TENSOR_FEATURES, _check_tensor_example),
+}
+
+
+@pytest.fixture(scope="module")
+def wds_case(request, download_manager):
+    wds_file_fixture, expected_features, check_example = _WDS_CASES[request.param]
+    data_files = {"train": [request.getfixturevalue(wds_file_fixture)]}
     webdataset = WebDataset(data_files=data_files)
-    split_generators = webdataset._split_generators(DownloadManager())
-    assert webdataset.info.features == Features(
-        {
-            "__key__": Value("string"),
-            "__url__": Value("string"),
-            "json": {"caption": Value("string")},
-            "jpg": Image(),
-        }
-    )
+    split_generators = webdataset._split_generators(download_manager)
+    if request.param == "gzipped_text":
+        check_example = functools.partial(check_example, text_path=request.getfixturevalue("text_path"))
+    else:
+        check_example = functools.partial(check_example, features=webdataset.info.features)
+    return webdataset, split_generators, expected_features, check_example
+
+
+@pytest.mark.parametrize(
+    "wds_case",
+    [
+        pytest.param(
+            "gzipped_text",
+            marks=pytest.mark.skipif(not datasets.config.PIL_AVAILABLE, reason="test requires Pillow"),
+        ),
+        pytest.param(
+            "image", marks=pytest.mark.skipif(not datasets.config.PIL_AVAILABLE, reason="test requires Pillow")
+        ),
+        pytest.param(
+            "audio",
+            marks=pytest.mark.skipif(not datasets.config.TORCHCODEC_AVAILABLE, reason="test requires torchcodec"),
+        ),
+        pytest.param(
+            "tensor",
+            marks=[
+                require_numpy1_on_windows,
+                pytest.mark.skipif(not datasets.config.TORCH_AVAILABLE, reason="test requires PyTorch"),
+            ],
+        ),
+    ],
+    indirect=True,
+)
+def test_webdataset(wds_case):
+    webdataset, split_generators, expected_features, check_example = wds_case
+    assert webdataset.info.features == expected_features
     assert len(split_generators) == 1
     split_generator = split_generators[0]
     assert split_generator.name == "train"
     generator = webdataset._generate_examples(**split_generator.gen_kwargs)
-    _, examples = zip(*generator)
-    assert len(examples) == 3
-    assert isinstance(examples[0]["json"], dict)
-    assert isinstance(examples[0]["json"]["caption"], str)
-    assert isinstance(examples[0]["jpg"], dict)  # keep encoded to avoid unecessary copies
-    encoded = webdataset.info.features.encode_example(examples[0])
-    decoded = webdataset.info.features.decode_example(encoded)
-    assert isinstance(decoded["json"], dict)
-    assert isinstance(decoded["json"]["caption"], str)
-    assert isinstance(decoded["jpg"], PIL.Image.Image)
+    _, first_example = next(generator)
+    assert 1 + sum(1 for _ in generator) == 3
+    check_example(first_example)
 
 
-def test_upper_lower_case(upper_lower_case_file):
+def test_upper_lower_case(upper_lower_case_file, download_manager):
     variants = [
         ("INFO1", "json"),
         ("info2", "json"),
@@ -179,7 +341,7 @@ def test_upper_lower_case(upper_lower_case_file):
 
     data_files = {"train": [upper_lower_case_file]}
     webdataset = WebDataset(data_files=data_files)
-    split_generators = webdataset._split_generators(DownloadManager())
+    split_generators = webdataset._split_generators(download_manager)
 
     variant_keys = [f"{tag}.{ext}" for tag, ext in variants]
     assert webdataset.info.features == Features(
@@ -194,7 +356,7 @@ def test_upper_lower_case(upper_lower_case_file):
     split_generator = split_generators[0]
     assert split_generator.name == "train"
     generator = webdataset._generate_examples(**split_generator.gen_kwargs)
-    _, examples = zip(*generator)
+    examples = [example for _, example in generator]
 
     assert len(examples) == 3
     for example_idx, example in enumerate(examples):
@@ -213,22 +375,11 @@ def test_upper_lower_case(upper_lower_case_file):
 
 
 @require_pil
-def test_image_webdataset_missing_keys(image_wds_file):
-    import PIL.Image
-
+def test_image_webdataset_missing_keys(image_wds_file, download_manager):
     data_files = {"train": [image_wds_file]}
-    features = Features(
-        {
-            "__key__": Value("string"),
-            "__url__": Value("string"),
-            "json": {"caption": Value("string")},
-            "jpg": Image(),
-            "jpeg": Image(),  # additional field
-            "txt": Value("string"),  # additional field
-        }
-    )
+    features = _USER_IMAGE_FEATURES_MISSING_KEYS
     webdataset = WebDataset(data_files=data_files, features=features)
-    split_generators = webdataset._split_generators(DownloadManager())
+    split_generators = webdataset._split_generators(download_manager)
     assert webdataset.info.features == features
     split_generator = split_generators[0]
     assert split_generator.name == "train"
@@ -243,83 +394,35 @@ def test_image_webdataset_missing_keys(image_wds_file):
     assert decoded["txt"] is None
 
 
-@require_torchcodec
-def test_audio_webdataset(audio_wds_file):
-    from torchcodec.decoders import AudioDecoder
-
-    data_files = {"train": [audio_wds_file]}
-    webdataset = WebDataset(data_files=data_files)
-    split_generators = webdataset._split_generators(DownloadManager())
-    assert webdataset.info.features == Features(
-        {
-            "__key__": Value("string"),
-            "__url__": Value("string"),
-            "json": {"transcript": Value("string")},
-            "wav": Audio(),
-        }
-    )
-    assert len(split_generators) == 1
-    split_generator = split_generators[0]
-    assert split_generator.name == "train"
-    generator = webdataset._generate_examples(**split_generator.gen_kwargs)
-    _, examples = zip(*generator)
-    assert len(examples) == 3
-    assert isinstance(examples[0]["json"], dict)
-    assert isinstance(examples[0]["json"]["transcript"], str)
-    assert isinstance(examples[0]["wav"], dict)
-    assert isinstance(examples[0]["wav"]["bytes"], bytes)  # keep encoded to avoid unecessary copies
-    encoded = webdataset.info.features.encode_example(examples[0])
-    decoded = webdataset.info.features.decode_example(encoded)
-    assert isinstance(decoded["json"], dict)
-    assert isinstance(decoded["json"]["transcript"], str)
-    assert isinstance(decoded["wav"], AudioDecoder)
-
-
-def test_video_webdataset(video_wds_file):
+def test_video_webdataset(video_wds_file, download_manager):
     data_files = {"train": [video_wds_file]}
     webdataset = WebDataset(data_files=data_files)
-    split_generators = webdataset._split_generators(DownloadManager())
-    assert webdataset.info.features == Features(
-        {
-            "__key__": Value("string"),
-            "__url__": Value("string"),
-            "json": {"caption": Value("string")},
-            "mov": Video(),
-        }
-    )
+    split_generators = webdataset._split_generators(download_manager)
+    assert webdataset.info.features == _EXPECTED_VIDEO_FEATURES
     assert len(split_generators) == 1
     split_generator = split_generators[0]
     assert split_generator.name == "train"
     generator = webdataset._generate_examples(**split_generator.gen_kwargs)
-    _, examples = zip(*generator)
-    assert len(examples) == 3
-    assert isinstance(examples[0]["json"], dict)
-    assert isinstance(examples[0]["json"]["caption"], str)
-    assert isinstance(examples[0]["mov"], dict)
+    _, first_example = next(generator)
+    assert 1 + sum(1 for _ in generator) == 3
+    assert isinstance(first_example["json"], dict)
+    assert isinstance(first_example["json"]["caption"], str)
+    assert isinstance(first_example["mov"], dict)
 
 
-def test_webdataset_errors_on_bad_file(bad_wds_file):
+def test_webdataset_errors_on_bad_file(bad_wds_file, download_manager):
     data_files = {"train": [bad_wds_file]}
     webdataset = WebDataset(data_files=data_files)
     with pytest.raises(ValueError):
-        webdataset._split_generators(DownloadManager())
+        webdataset._split_generators(download_manager)
 
 
 @require_pil
-def test_webdataset_with_features(image_wds_file):
-    import PIL.Image
-
+def test_webdataset_with_features(image_wds_file, download_manager):
     data_files = {"train": [image_wds_file]}
-    features = Features(
-        {
-            "__key__": Value("string"),
-            "__url__": Value("string"),
-            "json": {"caption": Value("string"), "additional_field": Value("int64")},
-            "jpg": Image(),
-        }
-    )
+    features = _USER_IMAGE_FEATURES_EXTRA_FIELD
     webdataset = WebDataset(data_files=data_files, features=features)
-    split_generators = webdataset._split_generators(DownloadManager())
+    split_generators = webdataset._split_generators(download_manager)
     assert webdataset.info.features == features
     split_generator = split_generators[0]
     assert split_generator.name == "train"
@@ -331,35 +434,3 @@ def test_webdataset_with_features(image_wds_file):
     assert isinstance(decoded["json"], dict)
     assert isinstance(decoded["json"]["caption"], str)
     assert isinstance(decoded["jpg"], PIL.Image.Image)
-
-
-@require_numpy1_on_windows
-@require_torch
-def test_tensor_webdataset(tensor_wds_file):
-    import torch
-
-    data_files = {"train": [tensor_wds_file]}
-    webdataset = WebDataset(data_files=data_files)
-    split_generators = webdataset._split_generators(DownloadManager())
-    assert webdataset.info.features == Features(
-        {
-            "__key__": Value("string"),
-            "__url__": Value("string"),
-            "json": {"text": Value("string")},
-            "pth": List(Value("float32")),
-        }
-    )
-    assert len(split_generators) == 1
-    split_generator = split_generators[0]
-    assert split_generator.name == "train"
-    generator = webdataset._generate_examples(**split_generator.gen_kwargs)
-    _, examples = zip(*generator)
-    assert len(examples) == 3
-    assert isinstance(examples[0]["json"], dict)
-    assert isinstance(examples[0]["json"]["text"], str)
-    assert isinstance(examples[0]["pth"], torch.Tensor)  # keep encoded to avoid unecessary copies
-    encoded = webdataset.info.features.encode_example(examples[0])
-    decoded = webdataset.info.features.decode_example(encoded)
-    assert isinstance(decoded["json"], dict)
-    assert isinstance(decoded["json"]["text"], str)
-    assert isinstance(decoded["pth"], list)